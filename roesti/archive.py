@@ -0,0 +1,182 @@
+"""
+Dump and load hashed tables as a gzipped stream of JSON lines.
+
+The first line is a header. Each following line holds a chunk of rows of one
+model in columnar form, eg.
+
+    {"model": "app.Model", "columns": {"content_hash": [...], "text": [...]}}
+
+Models are written so that referenced tables come before the tables that
+refer to them.
+"""
+import gzip
+import io
+import json
+
+from django.apps import apps
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from roesti.gc import (
+    chunked, get_hashed_models, get_sweep_order, is_hashed_model, mark)
+from roesti.models import HashedListItemModel, HashedModel
+
+
+FORMAT = 'roesti'
+VERSION = 1
+
+
+def is_content_addressed(model):
+    """
+    Whether rows of `model` are keyed by their content hash. The rows of a
+    HashedListItemModel have an automatic primary key instead, and are
+    identified by the list they belong to.
+    """
+    return not issubclass(model, HashedListItemModel)
+
+
+def get_columns(model):
+    return [
+        field
+        for field in model._meta.concrete_fields
+        if is_content_addressed(model) or not field.primary_key
+    ]
+
+
+def dump(roots, fileobj, batch_size=1000):
+    """
+    Writes all rows reachable from `roots` to the binary file `fileobj`.
+    `roots` may be models or querysets, as for `roesti.gc.mark`.
+
+    Returns a mapping of {model: number of rows written}.
+    """
+    marked = mark(roots, batch_size, external_roots=False)
+    counts = {}
+
+    with gzip.GzipFile(fileobj=fileobj, mode='wb') as stream:
+        writer = io.TextIOWrapper(stream, encoding='utf-8')
+        _write_line(writer, {'format': FORMAT, 'version': VERSION})
+
+        for model in reversed(get_sweep_order(get_hashed_models())):
+            pks = sorted(marked.get(model, ()))
+            counts[model] = len(pks)
+            fields = get_columns(model)
+            for chunk in chunked(pks, batch_size):
+                rows = model._default_manager.filter(
+                    pk__in=chunk).order_by('pk').values_list(
+                        *[field.attname for field in fields])
+                columns = list(zip(*rows))
+                _write_line(writer, {
+                    'model': model._meta.label,
+                    'columns': {
+                        field.attname: list(column)
+                        for field, column in zip(fields, columns)
+                    }
+                })
+        writer.flush()
+        writer.detach()
+
+    return counts
+
+
+def _write_line(writer, obj):
+    writer.write(json.dumps(obj, cls=DjangoJSONEncoder))
+    writer.write('\n')
+
+
+@transaction.atomic
+def load(fileobj):
+    """
+    Reads rows written by `dump` from the binary file `fileobj`, inserting
+    those that don't already exist. Existence is checked by content hash,
+    one chunk at a time. The items of a HashedList are only inserted along
+    with the list itself.
+
+    Only hashed tables may be loaded. The inserted rows of models whose
+    hashes can be recalculated are checked against their content hash once
+    everything is inserted. Raises ValueError for a malformed archive or
+    mismatched rows, in which case nothing is inserted.
+
+    Returns a mapping of {model: number of rows inserted}.
+    """
+    counts = {}
+    # The keys of rows that were inserted by this load, by model.
+    inserted = {}
+
+    with gzip.GzipFile(fileobj=fileobj, mode='rb') as stream:
+        lines = io.TextIOWrapper(stream, encoding='utf-8')
+
+        header = json.loads(next(lines, 'null'))
+        if not header or header.get('format') != FORMAT:
+            raise ValueError('Not a roesti archive')
+        if header.get('version') != VERSION:
+            raise ValueError(
+                'Unsupported archive version: %s' % header.get('version'))
+
+        for line in lines:
+            chunk = json.loads(line)
+            if (not isinstance(chunk, dict) or 'model' not in chunk or
+                    not isinstance(chunk.get('columns'), dict)):
+                raise ValueError('Malformed archive chunk')
+            model = apps.get_model(chunk['model'])
+            if not is_hashed_model(model):
+                raise ValueError(
+                    '%s is not a hashed model' % model._meta.label)
+            instances = _load_chunk(model, chunk['columns'], inserted)
+            model._default_manager.bulk_create(instances)
+
+            counts[model] = counts.get(model, 0) + len(instances)
+            if is_content_addressed(model):
+                inserted.setdefault(model, set()).update(
+                    instance.pk for instance in instances)
+
+    # Rows are only checked now, as the hash of a row may include reverse
+    # relations that are inserted after it.
+    _verify_inserted(inserted)
+
+    return counts
+
+
+def _verify_inserted(inserted, chunk_size=1000):
+    for model, pks in inserted.items():
+        if not (issubclass(model, HashedModel) and
+                model._default_manager.is_checkable()):
+            continue
+        for chunk in chunked(pks, chunk_size):
+            mismatched = model._default_manager.get_mismatched(
+                model._default_manager.filter(pk__in=chunk))
+            if mismatched:
+                raise ValueError(
+                    '%d %s rows do not match their content hash, eg. %s' % (
+                        len(mismatched), model._meta.label,
+                        min(mismatched)))
+
+
+def _load_chunk(model, columns, inserted):
+    fields = [
+        field for field in get_columns(model) if field.attname in columns
+    ]
+    rows = [
+        {
+            field.attname: field.to_python(value)
+            for field, value in zip(fields, values)
+        }
+        for values in zip(*(columns[field.attname] for field in fields))
+    ]
+
+    if is_content_addressed(model):
+        # Skip the rows that the database already has.
+        attname = model._meta.pk.attname
+        if attname not in columns:
+            raise ValueError('Archive chunk is missing %s' % attname)
+        existing = set(model._default_manager.filter(
+            pk__in=[row[attname] for row in rows]).values_list(
+                'pk', flat=True))
+        rows = [row for row in rows if row[attname] not in existing]
+    else:
+        # List items are only new if their list is.
+        field = model._meta.get_field('list_hash')
+        new_lists = inserted.get(field.related_model, set())
+        rows = [row for row in rows if row[field.attname] in new_lists]
+
+    return [model(**row) for row in rows]
@@ -0,0 +1,199 @@
+import collections
+
+from django.apps import apps
+from django.db import models, transaction
+
+from roesti.models import HashedList, HashedListItemModel, HashedModel
+
+
+def is_hashed_model(model):
+    return issubclass(model, (HashedModel, HashedList, HashedListItemModel))
+
+
+def get_hashed_models():
+    return [model for model in apps.get_models() if is_hashed_model(model)]
+
+
+def get_references(model):
+    """
+    Get the foreign key fields of `model` that refer to other hashed tables.
+    """
+    return [
+        field
+        for field in model._meta.get_fields()
+        if isinstance(field, models.ForeignKey) and
+        is_hashed_model(field.related_model)
+    ]
+
+
+def is_owned_by(field):
+    """
+    Whether the rows holding foreign key `field` are part of the content of
+    the row they refer to, such as the items of a `HashedList`, or reverse
+    relations that are listed in a HashedModel's `hash_fields`.
+    """
+    if issubclass(field.model, HashedListItemModel):
+        return field.name == 'list_hash'
+    parent = field.related_model
+    if issubclass(parent, HashedModel):
+        accessor_name = field.remote_field.get_accessor_name()
+        return accessor_name in getattr(parent, 'hash_fields', ())
+    return False
+
+
+def get_external_roots():
+    """
+    Get a mapping of {model: querysets of pk values} for each row of a hashed
+    table that is referenced from a table outside of the hashed graph. These
+    rows are always treated as reachable.
+    """
+    roots = collections.defaultdict(list)
+    for model in apps.get_models(include_auto_created=True):
+        if is_hashed_model(model):
+            continue
+        for field in get_references(model):
+            roots[field.related_model].append(
+                model._default_manager.filter(**{
+                    '%s__isnull' % field.name: False
+                }).values_list(field.attname, flat=True))
+    return roots
+
+
+def chunked(values, size):
+    values = list(values)
+    for index in range(0, len(values), size):
+        yield values[index:index + size]
+
+
+def mark(roots, batch_size=1000, external_roots=True, allow_no_roots=False):
+    """
+    Returns a mapping of {model: set of pks} of all rows reachable from
+    `roots`, which may be models (all of their rows are roots) or querysets.
+    If `external_roots`, rows referenced from tables outside of the hashed
+    graph are roots as well.
+
+    Raises ValueError if `roots` is empty, unless `allow_no_roots`, since
+    then almost nothing is reachable.
+    """
+    roots = list(roots)
+    if not roots and not allow_no_roots:
+        raise ValueError('No roots given')
+
+    frontier = collections.defaultdict(set)
+    for root in roots:
+        if isinstance(root, models.QuerySet):
+            model, queryset = root.model, root
+        else:
+            model, queryset = root, root._default_manager.all()
+        frontier[model].update(queryset.values_list('pk', flat=True))
+    if external_roots:
+        for model, querysets in get_external_roots().items():
+            for queryset in querysets:
+                frontier[model].update(queryset)
+
+    # Owned rows hold the foreign key, so are found by following it in
+    # reverse, eg. {HashedList: [(TestListItem, list_hash field)]}
+    owned = collections.defaultdict(list)
+    for model in get_hashed_models():
+        for field in get_references(model):
+            if is_owned_by(field):
+                owned[field.related_model].append((model, field))
+
+    marked = collections.defaultdict(set)
+    while frontier:
+        model, pks = frontier.popitem()
+        pks -= marked[model]
+        if not pks:
+            continue
+        marked[model].update(pks)
+
+        for chunk in chunked(pks, batch_size):
+            rows = model._default_manager.filter(pk__in=chunk)
+            for field in get_references(model):
+                frontier[field.related_model].update(
+                    value for value in rows.values_list(field.attname,
+                                                        flat=True)
+                    if value is not None)
+            for child, field in owned[model]:
+                frontier[child].update(
+                    child._default_manager.filter(**{
+                        '%s__in' % field.attname: chunk
+                    }).values_list('pk', flat=True))
+
+    return marked
+
+
+def get_sweep_order(hashed_models):
+    """
+    Orders `hashed_models` so that tables are swept before the tables they
+    refer to.
+    """
+    ordered = []
+    visited = set()
+
+    def visit(model):
+        if model in visited:
+            return
+        visited.add(model)
+        for other in hashed_models:
+            if any(field.related_model == model and other != model
+                   for field in get_references(other)):
+                visit(other)
+        ordered.append(model)
+
+    for model in hashed_models:
+        visit(model)
+    return ordered
+
+
+def sweep(marked, batch_size=1000, dry_run=False):
+    """
+    Deletes rows of hashed tables that aren't in `marked`, at most
+    `batch_size` rows per query. If `dry_run`, nothing is deleted.
+
+    Returns an ordered mapping of {model: number of unreachable rows}.
+    """
+    report = collections.OrderedDict()
+    for model in get_sweep_order(get_hashed_models()):
+        reachable = marked.get(model, set())
+        report[model] = 0
+
+        # Page through the table by primary key, so deleting rows doesn't
+        # disturb the pages still to come.
+        queryset = model._default_manager.order_by('pk')
+        last_pk = None
+        while True:
+            page = queryset
+            if last_pk is not None:
+                page = page.filter(pk__gt=last_pk)
+            pks = list(page.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
+
+            garbage = [pk for pk in pks if pk not in reachable]
+            report[model] += len(garbage)
+            if garbage and not dry_run:
+                with transaction.atomic():
+                    model._default_manager.filter(pk__in=garbage).delete()
+
+    return report
+
+
+def collect(roots, batch_size=1000, dry_run=False, allow_no_roots=False):
+    """
+    Mark-and-sweep garbage collection of hashed tables. Rows that can't be
+    reached by following foreign keys from `roots`, or from tables outside of
+    the hashed graph, are deleted in batches of `batch_size`.
+
+    An empty `roots` would delete every row that isn't referenced from
+    outside of the hashed graph, so raises ValueError unless
+    `allow_no_roots`.
+
+    Rows ensured while this runs may refer to rows that weren't marked, so
+    this should be run while nothing is writing to the hashed tables.
+
+    Returns an ordered mapping of {model: number of unreachable rows}.
+    """
+    marked = mark(roots, batch_size, allow_no_roots=allow_no_roots)
+    return sweep(marked, batch_size=batch_size, dry_run=dry_run)
@@ -0,0 +1,133 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import random
+
+from django.db import connections
+
+from roesti.gc import chunked
+
+
+# Rows are partitioned by the first four hex digits of their content hash.
+PREFIX_LENGTH = 4
+PREFIX_COUNT = 16 ** PREFIX_LENGTH
+
+IntegrityReport = collections.namedtuple(
+    'IntegrityReport', ['checked', 'mismatched', 'duplicates'])
+
+
+def check(model, chunk_size=1000, workers=1, sample=None):
+    """
+    Recalculates the content hash of the rows of HashedModel `model`, a
+    chunk of `chunk_size` rows at a time. Each chunk is read with its own
+    query, paging through the table by primary key, so only one chunk is
+    held in memory at a time. `model` must be checkable, see
+    `HashedModelManager.is_checkable`.
+
+    With more than one of `workers`, ranges of content hashes are checked on
+    separate threads, each with its own database connection. If `sample` is
+    given, only a random range of hashes covering about that fraction of the
+    table is checked.
+
+    Returns an `IntegrityReport` of the number of rows checked, a mapping of
+    {pk: content hash} of rows whose primary key doesn't match their content,
+    and a mapping of {content hash: list of pks} of rows that have the same
+    content.
+    """
+    if not model._default_manager.is_checkable():
+        raise ValueError(
+            'Content hashes of %s cannot be recalculated' % model._meta.label)
+    if workers < 1:
+        raise ValueError('workers must be at least 1')
+    if sample is not None and not 0 < sample <= 1:
+        raise ValueError('sample must be greater than 0 and at most 1')
+
+    start, stop = 0, PREFIX_COUNT
+    if sample is not None:
+        width = max(1, int(PREFIX_COUNT * sample))
+        start = random.randint(0, PREFIX_COUNT - width)
+        stop = start + width
+
+    step = -(-(stop - start) // workers)
+    ranges = [
+        (lower, min(lower + step, stop))
+        for lower in range(start, stop, step)
+    ]
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            results = list(executor.map(
+                lambda bounds: _check_range_in_worker(model, chunk_size,
+                                                      *bounds),
+                ranges))
+    else:
+        results = [_check_range(model, chunk_size, *bounds)
+                   for bounds in ranges]
+
+    checked = sum(count for count, mismatched in results)
+    mismatched = {}
+    for count, range_mismatched in results:
+        mismatched.update(range_mismatched)
+
+    return IntegrityReport(checked, mismatched,
+                           get_duplicates(model, mismatched, chunk_size))
+
+
+def _get_range_queryset(model, start, stop):
+    queryset = model._default_manager.filter(
+        pk__gte='%0*x' % (PREFIX_LENGTH, start))
+    if stop < PREFIX_COUNT:
+        queryset = queryset.filter(pk__lt='%0*x' % (PREFIX_LENGTH, stop))
+    return queryset
+
+
+def _check_range(model, chunk_size, start, stop):
+    queryset = _get_range_queryset(model, start, stop).order_by('pk')
+    checked = 0
+    mismatched = {}
+    last_pk = None
+    while True:
+        page = queryset
+        if last_pk is not None:
+            page = page.filter(pk__gt=last_pk)
+        chunk = list(page[:chunk_size])
+        if not chunk:
+            break
+        last_pk = chunk[-1].pk
+        checked += len(chunk)
+        mismatched.update(model._default_manager.get_mismatched(chunk))
+    return checked, mismatched
+
+
+def _check_range_in_worker(model, chunk_size, start, stop):
+    # Runs on a worker thread, so Django hands us a connection of our own.
+    # Close it when done so it isn't leaked with the thread.
+    try:
+        return _check_range(model, chunk_size, start, stop)
+    finally:
+        connections[model._default_manager.db].close()
+
+
+def get_duplicates(model, mismatched, chunk_size=1000):
+    """
+    Finds rows with the same content as the `mismatched` rows. Rows can only
+    share content if at least one of them is mismatched, so only those
+    content hashes are looked up.
+
+    Returns a mapping of {content hash: list of pks}.
+    """
+    rows = collections.defaultdict(set)
+    for pk, content_hash in mismatched.items():
+        rows[content_hash].add(pk)
+
+    for chunk in chunked(rows, chunk_size):
+        for pk in model._default_manager.filter(
+                pk__in=chunk).values_list('pk', flat=True):
+            # A mismatched row doesn't have the content its key implies.
+            if pk not in mismatched:
+                rows[pk].add(pk)
+
+    return {
+        content_hash: sorted(pks)
+        for content_hash, pks in rows.items()
+        if len(pks) > 1
+    }
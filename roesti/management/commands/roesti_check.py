@@ -0,0 +1,68 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from roesti.integrity import check
+from roesti.models import HashedModel
+
+
+class Command(BaseCommand):
+    help = (
+        'Recalculates the content hashes of HashedModel tables, and reports '
+        'rows that do not match their content hash or duplicate the content '
+        'of another row.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'models', nargs='+',
+            help='The models to check, as app_label.ModelName.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Number of rows to check at a time.')
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of threads to check rows with.')
+        parser.add_argument(
+            '--sample', type=float, default=None,
+            help='Only check about this fraction of rows, eg. 0.01.')
+
+    def handle(self, *args, **options):
+        try:
+            models = [apps.get_model(label) for label in options['models']]
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+        for model in models:
+            if not issubclass(model, HashedModel):
+                raise CommandError(
+                    '%s is not a HashedModel' % model._meta.label)
+            if not model.objects.is_checkable():
+                raise CommandError(
+                    'Content hashes of %s cannot be recalculated' %
+                    model._meta.label)
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1')
+        sample = options['sample']
+        if sample is not None and not 0 < sample <= 1:
+            raise CommandError(
+                '--sample must be greater than 0 and at most 1')
+
+        failed = False
+        for model in models:
+            report = check(model, chunk_size=options['chunk_size'],
+                           workers=options['workers'],
+                           sample=options['sample'])
+            label = model._meta.label
+            self.stdout.write('%s: %d rows checked, %d mismatched, '
+                              '%d duplicated' % (label, report.checked,
+                                                 len(report.mismatched),
+                                                 len(report.duplicates)))
+            for pk, content_hash in sorted(report.mismatched.items()):
+                self.stdout.write('  %s has content hash %s' % (
+                    pk, content_hash))
+            for content_hash, pks in sorted(report.duplicates.items()):
+                self.stdout.write('  %s have the same content (%s)' % (
+                    ', '.join(pks), content_hash))
+            failed = failed or report.mismatched or report.duplicates
+
+        if failed:
+            raise CommandError('Integrity check failed')
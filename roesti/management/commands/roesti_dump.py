@@ -0,0 +1,33 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from roesti.archive import dump
+
+
+class Command(BaseCommand):
+    help = (
+        'Writes the rows of hashed tables that are reachable from the root '
+        'models to a compressed archive.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Path of the archive to write.')
+        parser.add_argument(
+            '--root', action='append', dest='roots', required=True,
+            help='A root model, as app_label.ModelName. May be repeated.')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Maximum number of rows per chunk.')
+
+    def handle(self, *args, **options):
+        try:
+            roots = [apps.get_model(label) for label in options['roots']]
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+
+        with open(options['path'], 'wb') as fileobj:
+            counts = dump(roots, fileobj, batch_size=options['batch_size'])
+
+        for model, count in counts.items():
+            self.stdout.write('%s: %d rows written' % (
+                model._meta.label, count))
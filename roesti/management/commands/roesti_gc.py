@@ -0,0 +1,45 @@
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from roesti.gc import collect
+
+
+class Command(BaseCommand):
+    help = (
+        'Deletes rows of hashed tables that are not reachable from the root '
+        'models given by --root or the ROESTI_GC_ROOTS setting, or from '
+        'tables outside of the hashed graph.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--root', action='append', dest='roots', default=None,
+            help='A root model, as app_label.ModelName. May be repeated.')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Maximum number of rows to delete per query.')
+        parser.add_argument(
+            '--dry-run', action='store_true', default=False,
+            help='Report unreachable rows without deleting them.')
+
+    def handle(self, *args, **options):
+        labels = options['roots']
+        if labels is None:
+            labels = getattr(settings, 'ROESTI_GC_ROOTS', [])
+        if not labels:
+            raise CommandError(
+                'No roots given: pass --root or set ROESTI_GC_ROOTS')
+
+        try:
+            roots = [apps.get_model(label) for label in labels]
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+
+        report = collect(roots, batch_size=options['batch_size'],
+                         dry_run=options['dry_run'])
+
+        action = 'would be deleted' if options['dry_run'] else 'deleted'
+        for model, count in report.items():
+            self.stdout.write('%s: %d unreachable rows %s' % (
+                model._meta.label, count, action))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from roesti.archive import load
+
+
+class Command(BaseCommand):
+    help = (
+        'Loads an archive written by roesti_dump, skipping rows that already '
+        'exist.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Path of the archive to read.')
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['path'], 'rb') as fileobj:
+                counts = load(fileobj)
+        except (LookupError, OSError, ValueError) as e:
+            raise CommandError(e)
+
+        for model, count in counts.items():
+            self.stdout.write('%s: %d rows inserted' % (
+                model._meta.label, count))
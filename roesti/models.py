@@ -1,8 +1,15 @@
 import collections
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import md5
+import logging
 import pickle
+import random
 
-from django.db import models, transaction
+from django.conf import settings
+from django.db import connections, models, transaction
+
+
+logger = logging.getLogger(__name__)
 
 
 def freeze(obj):
@@ -26,13 +33,55 @@ def make_hash(obj):
     return md5(pickle.dumps(freeze(obj))).hexdigest()
 
 
+# Checked before falling back to the slower `isinstance` in `get_memo_key`.
+NESTED_TYPES = frozenset([dict, list, set, tuple])
+SCALAR_TYPES = frozenset([str, int, float, bool, type(None)])
+
+
+def get_memo_key(Model, item_dict):
+    """
+    Returns a key identifying `item_dict` for `Model`, or None if it has
+    nested values or can't be used as a key. Only the dict's own values are
+    looked at, so building the key costs no more than the dict's size.
+    """
+    values = []
+    for key, value in item_dict.items():
+        value_type = type(value)
+        if value_type in NESTED_TYPES or (
+                value_type not in SCALAR_TYPES and
+                isinstance(value, (collections.Mapping, list, set, tuple))):
+            return None
+        # Include the type, so eg. `1` and `True` aren't confused.
+        values.append((key, value_type, value))
+    try:
+        return (Model, frozenset(values))
+    except TypeError:
+        return None
+
+
 class HashedModelManager(models.Manager):
-    def from_dict(self, item_dict):
+    def from_dict(self, item_dict, memo=None):
         """
         Constructor that also initializes `content_hash`.
+
+        If `memo` is given, it is used to cache the results for dicts whose
+        values are all scalars, such as a `details` dict repeated under many
+        list items. Identical dicts sharing a memo are only converted and
+        hashed once.
         """
+        key = None
+        if memo is not None:
+            key = get_memo_key(self.model, item_dict)
+        if key is None:
+            return self._from_dict(item_dict, memo)
+
+        if key not in memo:
+            memo[key] = self._from_dict(item_dict, memo)
+        return memo[key]
+
+    def _from_dict(self, item_dict, memo):
         instance = self.model()
-        related = instance.set_dict(item_dict)
+        related = instance.set_dict(item_dict, memo)
         return instance, related
 
     @transaction.atomic
@@ -48,18 +97,68 @@ class HashedModelManager(models.Manager):
         """
         return list(self._ensure_impl(items))
 
+    def ensure_parallel(self, items, workers=4):
+        """
+        Like `HashedModelManager.ensure`, but splits the batch into `workers`
+        partitions by content hash prefix and inserts each partition on its
+        own thread, with its own database connection and transaction.
+
+        Referenced HashedModel tables are ensured (and committed) before the
+        rows that depend on them. On SQLite, which only supports a single
+        writer, the partitions are inserted one after another.
+
+        Unlike `ensure`, the batch as a whole is not atomic, so this must not
+        be called from within a transaction: the worker connections couldn't
+        see its uncommitted rows, and could block on them.
+
+        Returns list of model instances.
+        """
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+        if connections[self.db].in_atomic_block:
+            raise transaction.TransactionManagementError(
+                'ensure_parallel cannot be called within a transaction')
+
+        instances, related_mapping = self._normalize_items(items)
+
+        instances = self._do_insert_parallel(self.model, instances, workers)
+
+        # Now, insert all the instances that have back-references to this one.
+        for (model, field_name), related_instances in related_mapping.items():
+            self._do_insert_parallel(model, related_instances, workers,
+                                     skip_ensure=[self.model])
+
+        return list(instances)
+
     def _ensure_impl(self, items):
         """
         Implmentation of `HashedModelManager.ensure`.
         In separate function so we can avoid nested transactions.
         """
-        # Normalize `items` into a list of model instances where the primary
-        # key is properly set.
+        instances, related_mapping = self._normalize_items(items)
+
+        instances = self._do_insert(self.model, instances)
+
+        # Now, insert all the instances that have back-references to this one.
+        for (model, field_name), related_instances in related_mapping.items():
+            self._do_insert(model, related_instances, skip_ensure=[self.model])
+
+        return instances
+
+    def _normalize_items(self, items, memo=None):
+        """
+        Normalize `items` into a list of model instances where the primary
+        key is properly set, and a mapping of the reverse-related instances
+        that need to be inserted after them.
+        """
         instances = []
         related_mapping = collections.defaultdict(set)
+        # Identical sub-structures are only hashed once per call.
+        if memo is None:
+            memo = {}
         for item in items:
             if isinstance(item, collections.Mapping):
-                instance, related_models = self.from_dict(item)
+                instance, related_models = self.from_dict(item, memo)
                 for key, related_instances in related_models.items():
                     related_mapping[key].update(related_instances)
                 instances.append(instance)
@@ -70,13 +169,22 @@ class HashedModelManager(models.Manager):
             else:
                 raise ValueError('Item must be a Mapping or HashedModel')
 
-        instances = self._do_insert(self.model, instances)
+        return instances, related_mapping
 
-        # Now, insert all the instances that have back-references to this one.
-        for (model, field_name), related_instances in related_mapping.items():
-            self._do_insert(model, related_instances, skip_ensure=[self.model])
-
-        return instances
+    def _get_table_references(self, InsertModel):
+        """
+        Get the foreign key fields of `InsertModel` that refer to other
+        HashedModels, aggregated by table.
+        eg, {table1: [field1, field2], table2: [field3]}
+        """
+        table_references = collections.defaultdict(list)
+        for field_name in InsertModel.hash_fields:
+            field = InsertModel._meta.get_field(field_name)
+            if isinstance(field, models.ForeignKey):
+                table = field.rel.to
+                if issubclass(table, HashedModel):
+                    table_references[table].append(field.name)
+        return table_references
 
     def _do_insert(self, InsertModel, instances, skip_ensure=[]):
         # Eliminate potential duplicate instances.
@@ -86,39 +194,173 @@ class HashedModelManager(models.Manager):
         }.values()
 
         # Ensure that foreign keys to other HashedModels exist.
-        # First, get the foreign key fields we need to work with, aggregated
-        # by table. eg, {table1: [field1, field2], table2: [field3]}
-        table_references = collections.defaultdict(list)
-        for field_name in InsertModel.hash_fields:
-            field = InsertModel._meta.get_field(field_name)
-            if isinstance(field, models.ForeignKey):
-                table = field.rel.to
-                if issubclass(table, HashedModel):
-                    table_references[table].append(field.name)
-
-        # Next, ensure that references for each table exist.
+        table_references = self._get_table_references(InsertModel)
         for table, field_names in table_references.items():
             if table in skip_ensure:
                 continue
-            table.objects._ensure_impl(getattr(instance, field_name)
-                                       for field_name in field_names
-                                       for instance in instances)
+            table.objects.db_manager(self.db)._ensure_impl(
+                getattr(instance, field_name)
+                for field_name in field_names
+                for instance in instances)
 
         # Get the keys of the items that already exist in the database.
         all_pks = set(inst.pk for inst in instances)
-        existing_pks = InsertModel.objects.filter(
+        existing_pks = InsertModel.objects.db_manager(self.db).filter(
             pk__in=all_pks).values_list('pk', flat=True)
 
+        self._verify_existing(InsertModel, existing_pks)
+
         # Insert instances that aren't in the db yet.
         # If everything already is in the db, skip the empty `bulk_create`.
         if len(all_pks) > len(existing_pks):
-            InsertModel.objects.bulk_create(instance
-                                            for instance in instances
-                                            if instance.pk not in existing_pks)
+            InsertModel.objects.db_manager(self.db).bulk_create(
+                instance
+                for instance in instances
+                if instance.pk not in existing_pks)
+
+        return instances
+
+    def _verify_existing(self, InsertModel, existing_pks):
+        """
+        Spot checks a sample of the rows of `InsertModel` that already exist,
+        if enabled by the `ROESTI_VERIFY_RATE` setting. Mismatches are logged.
+        """
+        verify_rate = getattr(settings, 'ROESTI_VERIFY_RATE', 0)
+        if not verify_rate or not InsertModel.objects.is_checkable():
+            return
+
+        sampled = [pk for pk in existing_pks if random.random() < verify_rate]
+        if sampled:
+            manager = InsertModel.objects.db_manager(self.db)
+            mismatched = manager.get_mismatched(
+                manager.filter(pk__in=sampled))
+            for pk, content_hash in mismatched.items():
+                logger.warning('%s %s has content hash %s',
+                               InsertModel._meta.label, pk, content_hash)
+
+    def is_checkable(self):
+        """
+        Whether stored content hashes can be recalculated from the rows.
+
+        That isn't the case if a hash field names a foreign key by its
+        related object rather than its `_id`, as the object was hashed as it
+        was when ensured. Nor if a hash field is the key of a parent whose
+        hash includes this model as a reverse relation, since the key isn't
+        set yet when this model's hash is calculated.
+        """
+        for field_name in self.model.hash_fields:
+            field = self.model._meta.get_field(field_name)
+            if not isinstance(field, models.ForeignKey):
+                continue
+            if field_name == field.name:
+                return False
+            parent_fields = getattr(field.related_model, 'hash_fields', ())
+            if field.remote_field.get_accessor_name() in parent_fields:
+                return False
+        return True
+
+    def get_mismatched(self, instances):
+        """
+        Recalculates the content hash of each of `instances`, which should
+        have been loaded from the database. Reverse relations that are part
+        of the hash are loaded with one query per relation. Only meaningful
+        for models that are `is_checkable`.
+
+        Returns a mapping of {pk: content hash} for the instances whose
+        primary key doesn't match their content hash.
+        """
+        instances = list(instances)
+        pks = [instance.pk for instance in instances]
+
+        # Group the reverse relations by the instance they refer to, eg.
+        # {(RelatedModel, field_name): {pk: set of related instances}}
+        reverse_relations = {}
+        for field_name in self.model.hash_fields:
+            field = self.model._meta.get_field(field_name)
+            if type(field) == models.ManyToOneRel:
+                RelatedModel = field.related_model
+                attname = field.remote_field.get_attname()
+                related = collections.defaultdict(set)
+                related_manager = RelatedModel.objects.db_manager(self.db)
+                for pk, related_pk in related_manager.filter(**{
+                        '%s__in' % attname: pks
+                }).values_list(attname, 'pk'):
+                    related[pk].add(RelatedModel(pk=related_pk))
+                reverse_relations[(RelatedModel, attname)] = related
+
+        mismatched = {}
+        for instance in instances:
+            content_hash = instance.get_content_hash({
+                key: related[instance.pk]
+                for key, related in reverse_relations.items()
+            })
+            if content_hash != instance.pk:
+                mismatched[instance.pk] = content_hash
+        return mismatched
+
+    def _do_insert_parallel(self, InsertModel, instances, workers,
+                            skip_ensure=[]):
+        # Eliminate potential duplicate instances.
+        instances = {
+            instance.pk: instance
+            for instance in instances
+        }.values()
+
+        # Ensure referenced tables first. Each of these calls only returns
+        # once its workers have committed, so the rows are visible to the
+        # connections used below.
+        table_references = self._get_table_references(InsertModel)
+        for table, field_names in table_references.items():
+            if table in skip_ensure:
+                continue
+            table.objects.db_manager(self.db)._do_insert_parallel(
+                table,
+                [getattr(instance, field_name)
+                 for field_name in field_names
+                 for instance in instances],
+                workers)
+
+        # Partitions never share a hash, so they can't conflict with each
+        # other. SQLite only allows a single writer, so there we work through
+        # the partitions one at a time.
+        partitions = partition_by_hash(instances, workers)
+        max_workers = len(partitions) or 1
+        if connections[self.db].vendor == 'sqlite':
+            max_workers = 1
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(_insert_partition, InsertModel, partition,
+                                list(table_references), self.db)
+                for partition in partitions
+            ]
+            for future in futures:
+                future.result()
 
         return instances
 
 
+def partition_by_hash(instances, count):
+    """
+    Split `instances` into at most `count` lists by the prefix of their
+    content hash. Empty partitions are omitted.
+    """
+    partitions = collections.defaultdict(list)
+    for instance in instances:
+        partitions[int(instance.pk[:4], 16) % count].append(instance)
+    return list(partitions.values())
+
+
+def _insert_partition(InsertModel, instances, skip_ensure, using):
+    # Runs on a worker thread, so Django hands us a connection of our own.
+    # Close it when done so it isn't leaked with the thread.
+    try:
+        with transaction.atomic(using=using):
+            InsertModel.objects.db_manager(using)._do_insert(
+                InsertModel, instances, skip_ensure=skip_ensure)
+    finally:
+        connections[using].close()
+
+
 class HashField(models.CharField):
     def __init__(self, **kwargs):
         defaults = {
@@ -132,8 +374,22 @@ class HashedModel(models.Model):
     objects = HashedModelManager()
     content_hash = HashField(primary_key=True)
 
-    def save(self, *args, **kwargs):
-        self.content_hash = self.get_content_hash()
+    @staticmethod
+    def batch():
+        """
+        Returns a `Batch`, to be used as a context manager that collects
+        ensures and writes them all on exit.
+        """
+        return Batch()
+
+    def save(self, *args, rehash=True, **kwargs):
+        """
+        Saves the instance, recalculating `content_hash` first. Pass
+        `rehash=False` to keep an existing `content_hash` when the hash fields
+        are known not to have changed.
+        """
+        if rehash or not self.content_hash:
+            self.content_hash = self.get_content_hash()
         super(HashedModel, self).save(*args, **kwargs)
 
     def _get_hash_field(self, field_name, reverse_relations):
@@ -164,7 +420,7 @@ class HashedModel(models.Model):
         for key, value in source.items():
             target[key].update(value)
 
-    def set_dict(self, item_dict):
+    def set_dict(self, item_dict, memo=None):
         # Will accumulate ManyToMany relations here, in the form:
         # {ModelClass: [instance1, instance2, ...]}
         reverse_relations = collections.defaultdict(set)
@@ -177,7 +433,8 @@ class HashedModel(models.Model):
                 # ... And it corresponds to a reference to another HashedModel,
                 # then try to instantiate it.
                 if issubclass(field.rel.to, HashedModel):
-                    value, related = field.rel.to.objects.from_dict(value)
+                    value, related = field.rel.to.objects.from_dict(
+                        value, memo)
                     self._accumulate_dict(reverse_relations, related)
 
             # If this is a non-string iterable...
@@ -191,7 +448,8 @@ class HashedModel(models.Model):
                     # For each reverse relation, create the instance and
                     # accumulate in `reverse_relations`.
                     for item in value:
-                        instance, related = RelatedModel.objects.from_dict(item)
+                        instance, related = RelatedModel.objects.from_dict(
+                            item, memo)
                         key = (RelatedModel, field.remote_field.get_attname())
                         reverse_relations[key].add(instance)
                         self._accumulate_dict(reverse_relations, related)
@@ -292,3 +550,144 @@ class HashedListItemModel(models.Model):
     class Meta:
         abstract = True
         ordering = ('order',)
+
+
+class Batch(object):
+    """
+    A unit of work for ensuring HashedModels and HashedLists. Instances are
+    hashed as they are added, but nothing is written to the database until
+    `flush`, which is called on leaving the `with` block:
+
+        with HashedModel.batch() as batch:
+            batch.ensure(TestModel, items)
+            batch.ensure_list(TestItem, list_items)
+
+    On flush, each table is checked for existing rows with one query and
+    written to with one `bulk_create`, in foreign key order. No savepoint is
+    created if this is called from within a transaction.
+    """
+    def __init__(self):
+        # {model: {pk: instance}}
+        self.pending = collections.defaultdict(collections.OrderedDict)
+        # {list_hash: list of item instances}
+        self.lists = collections.OrderedDict()
+        self.memo = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def ensure(self, Model, items):
+        """
+        Adds `items` to the batch, as for `HashedModelManager.ensure`.
+
+        Returns list of model instances, which are saved on flush.
+        """
+        instances, related_mapping = Model.objects._normalize_items(
+            items, self.memo)
+        for instance in instances:
+            self._add(instance)
+        for related_instances in related_mapping.values():
+            for instance in related_instances:
+                self._add(instance)
+
+        # Eliminate potential duplicate instances.
+        return list(collections.OrderedDict(
+            (instance.pk, instance) for instance in instances).values())
+
+    def ensure_list(self, ItemModel, items):
+        """
+        Adds a list of `items` to the batch, as for
+        `HashedListModelManager.ensure_list`.
+
+        Returns the `HashedList` instance, which is saved on flush.
+        """
+        item_instances = self.ensure(ItemModel, items)
+        list_hash = make_hash([item.pk for item in item_instances])
+        self.lists.setdefault(list_hash, item_instances)
+        return self.pending[HashedList].setdefault(
+            list_hash, HashedList(pk=list_hash))
+
+    def _add(self, instance):
+        Model = instance.__class__
+        if instance.pk in self.pending[Model]:
+            return
+        self.pending[Model][instance.pk] = instance
+
+        # Add referenced instances too. References that are only set by key,
+        # such as back-references, must already exist or be in the batch.
+        table_references = Model.objects._get_table_references(Model)
+        for field_names in table_references.values():
+            for field_name in field_names:
+                field = Model._meta.get_field(field_name)
+                if hasattr(instance, field.get_cache_name()):
+                    related = getattr(instance, field_name)
+                    if related is not None:
+                        self._add(related)
+
+    def flush(self):
+        """
+        Writes the pending instances and lists to the database.
+        """
+        pending, lists = self.pending, self.lists
+        self.pending = collections.defaultdict(collections.OrderedDict)
+        self.lists = collections.OrderedDict()
+
+        # The keys of the rows inserted by this flush, by model.
+        inserted = {}
+        models_to_insert = set(pending)
+        if lists:
+            models_to_insert.add(HashedList.items.field.model)
+
+        with transaction.atomic(savepoint=False):
+            for Model in get_insert_order(models_to_insert):
+                if issubclass(Model, HashedListItemModel):
+                    # Only new lists need their items assigned.
+                    new_lists = inserted.get(HashedList, set())
+                    Model.objects.bulk_create([
+                        Model(list_hash_id=list_hash, order=order,
+                              item=item)
+                        for list_hash, items in lists.items()
+                        if list_hash in new_lists
+                        for order, item in enumerate(items, 1)
+                    ])
+                    continue
+
+                instances = pending[Model]
+                existing_pks = set(Model.objects.filter(
+                    pk__in=list(instances)).values_list('pk', flat=True))
+                if issubclass(Model, HashedModel):
+                    Model.objects._verify_existing(Model, existing_pks)
+                new_instances = [instance
+                                 for pk, instance in instances.items()
+                                 if pk not in existing_pks]
+                if new_instances:
+                    Model.objects.bulk_create(new_instances)
+                inserted[Model] = set(
+                    instance.pk for instance in new_instances)
+
+
+def get_insert_order(models_to_insert):
+    """
+    Orders `models_to_insert` so that tables are inserted into after the
+    tables they refer to.
+    """
+    ordered = []
+    visited = set()
+
+    def visit(Model):
+        if Model in visited:
+            return
+        visited.add(Model)
+        for field in Model._meta.concrete_fields:
+            related_model = field.related_model
+            if related_model in models_to_insert and related_model != Model:
+                visit(related_model)
+        ordered.append(Model)
+
+    for Model in sorted(models_to_insert, key=lambda Model: Model.__name__):
+        visit(Model)
+    return ordered
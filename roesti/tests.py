@@ -1,8 +1,23 @@
-from django.db import models
-from django.test import TestCase
-
+from io import BytesIO, StringIO
+import gzip
+import json
+import os
+import pickle
+import tempfile
+from unittest import mock
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import models, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from roesti import models as roesti_models
+from roesti.archive import dump, load
+from roesti.gc import collect
+from roesti.integrity import check
 from roesti.models import (
-    HashedModel, HashedList, HashedListItemModel, make_hash)
+    HashedModel, HashedList, HashedListItemModel, make_hash,
+    partition_by_hash)
 
 
 def validate_hashes(test_case, instances):
@@ -418,3 +433,578 @@ class OrderedListTestCase(TestCase):
                 for frmt in ['Item %d', '1 Item %d', '2 Item %d', '3 Item %d']
             )
         )
+
+
+class ParallelEnsureTestCase(TransactionTestCase):
+    def test_partition_by_hash(self):
+        instances = TestModel.objects.ensure([{
+            'char_field_1': 'value %d' % index,
+            'integer_field_1': index
+        } for index in range(20)])
+        partitions = partition_by_hash(instances, 4)
+        self.assertLessEqual(len(partitions), 4)
+        self.assertEqual(
+            sorted(inst.pk for partition in partitions for inst in partition),
+            sorted(inst.pk for inst in instances))
+
+        # The same hash always lands in the same partition.
+        for partition in partitions:
+            self.assertEqual(len(partition_by_hash(partition, 4)), 1)
+
+    def test_ensure_parallel(self):
+        data = [{
+            'test_model_1': {
+                'char_field_1': 'value %d' % index,
+                'integer_field_1': index
+            },
+            'test_model_2': {
+                'char_field_1': 'value %d' % (index + 1),
+                'integer_field_1': index + 1
+            },
+            'integer_field_1': index
+        } for index in range(20)]
+
+        instances = TestReferencesModel.objects.ensure_parallel(data,
+                                                                workers=4)
+        self.assertEqual(len(instances), 20)
+        validate_hashes(self, instances)
+        self.assertEqual(TestModel.objects.count(), 21)
+        self.assertEqual(TestReferencesModel.objects.count(), 20)
+
+        # Ensuring the same data again adds nothing.
+        instances = TestReferencesModel.objects.ensure_parallel(data,
+                                                                workers=4)
+        self.assertEqual(len(instances), 20)
+        self.assertEqual(TestModel.objects.count(), 21)
+        self.assertEqual(TestReferencesModel.objects.count(), 20)
+
+    def test_ensure_parallel_workers(self):
+        with self.assertRaises(ValueError):
+            TestModel.objects.ensure_parallel([{
+                'char_field_1': 'value 1',
+                'integer_field_1': 1
+            }], workers=0)
+        self.assertEqual(TestModel.objects.count(), 0)
+
+    def test_ensure_parallel_in_transaction(self):
+        with transaction.atomic():
+            TestModel.objects.ensure([{
+                'char_field_1': 'value 1',
+                'integer_field_1': 1
+            }])
+            with self.assertRaises(transaction.TransactionManagementError):
+                TestReferencesModel.objects.ensure_parallel([{
+                    'test_model_1': {
+                        'char_field_1': 'value 1',
+                        'integer_field_1': 1
+                    },
+                    'test_model_2': {
+                        'char_field_1': 'value 2',
+                        'integer_field_1': 2
+                    },
+                    'integer_field_1': 1
+                }])
+        self.assertEqual(TestReferencesModel.objects.count(), 0)
+
+    def test_ensure_parallel_reverse_references(self):
+        instances = TestOrderedList.objects.ensure_parallel([{
+            'name': 'My list %d' % list_index,
+            'items': [{
+                'order': index,
+                'details': {
+                    'text': '%d Item %d' % (list_index, index)
+                }
+            } for index in range(10)]
+        } for list_index in range(3)], workers=3)
+        self.assertEqual(len(instances), 3)
+        self.assertEqual(TestOrderedList.objects.count(), 3)
+        self.assertEqual(TestItemDetails.objects.count(), 30)
+        self.assertEqual(TestOrderedListItem.objects.count(), 30)
+
+
+class HashMemoTestCase(TestCase):
+    def test_duplicate_sub_dicts_hashed_once(self):
+        data = [{
+            'name': 'My list',
+            'items': [{
+                'order': index,
+                'details': {
+                    'text': 'Same details'
+                }
+            } for index in range(10)]
+        }]
+
+        with mock.patch.object(roesti_models, 'make_hash',
+                               wraps=roesti_models.make_hash) as make_hash:
+            instances = TestOrderedList.objects.ensure(data)
+            # One for the list, one for each item, and one for the shared
+            # details.
+            self.assertEqual(make_hash.call_count, 12)
+
+        self.assertEqual(len(instances), 1)
+        self.assertEqual(TestItemDetails.objects.count(), 1)
+        self.assertEqual(TestOrderedListItem.objects.count(), 10)
+
+    def test_unique_dicts_not_rehashed(self):
+        # With nothing repeated, the memo mustn't add work: values are only
+        # pickled to calculate their hash.
+        data = [{
+            'name': 'List %d' % list_index,
+            'items': [{
+                'order': index,
+                'details': {
+                    'text': '%d Item %d' % (list_index, index)
+                }
+            } for index in range(5)]
+        } for list_index in range(3)]
+
+        with mock.patch.object(roesti_models, 'make_hash',
+                               wraps=roesti_models.make_hash) as make_hash, \
+                mock.patch.object(pickle, 'dumps',
+                                  wraps=pickle.dumps) as dumps:
+            TestOrderedList.objects.ensure(data)
+            # One for each list, item and details.
+            self.assertEqual(make_hash.call_count, 33)
+            self.assertEqual(dumps.call_count, make_hash.call_count)
+
+    def test_memo_key_types(self):
+        self.assertNotEqual(
+            roesti_models.get_memo_key(TestItem, {'text': 1}),
+            roesti_models.get_memo_key(TestItem, {'text': True}))
+        self.assertIsNone(
+            roesti_models.get_memo_key(TestItem, {'text': {'nested': 1}}))
+
+    def test_save_without_rehash(self):
+        instance = TestItemDetails(text='text')
+        instance.save()
+        self.assertEqual(instance.pk, instance.get_content_hash())
+
+        with mock.patch.object(roesti_models, 'make_hash') as make_hash:
+            instance.save(rehash=False)
+            self.assertFalse(make_hash.called)
+
+        with mock.patch.object(roesti_models, 'make_hash',
+                               wraps=roesti_models.make_hash) as make_hash:
+            instance.save()
+            self.assertTrue(make_hash.called)
+
+
+class GarbageCollectionTestCase(TestCase):
+    def setUp(self):
+        self.lists = TestOrderedList.objects.ensure([{
+            'name': 'List %d' % list_index,
+            'items': [{
+                'order': index,
+                'details': {
+                    'text': '%d Item %d' % (list_index, index)
+                }
+            } for index in range(5)]
+        } for list_index in range(2)])
+        TestItemDetails.objects.ensure([{'text': 'Orphan'}])
+
+        items = [TestItem(text='Item %d' % index) for index in range(5)]
+        self.hashed_list = HashedList.objects.ensure_list(TestItem, items)
+        HashedList.objects.ensure_list(TestItem, items[:2])
+
+    def test_dry_run(self):
+        report = collect([
+            TestOrderedList.objects.filter(pk=self.lists[0].pk),
+            TestListReference,
+        ], dry_run=True)
+        self.assertEqual(report[TestOrderedList], 1)
+        self.assertEqual(report[TestOrderedListItem], 5)
+        self.assertEqual(report[TestItemDetails], 6)
+        self.assertEqual(report[HashedList], 2)
+        self.assertEqual(report[TestListItem], 7)
+        self.assertEqual(report[TestItem], 5)
+
+        # Nothing was deleted.
+        self.assertEqual(TestOrderedList.objects.count(), 2)
+        self.assertEqual(TestItemDetails.objects.count(), 11)
+        self.assertEqual(HashedList.objects.count(), 2)
+
+    def test_collect(self):
+        TestListReference.objects.bulk_create([
+            TestListReference(content_hash='ref', lst=self.hashed_list)])
+        collect([
+            TestOrderedList.objects.filter(pk=self.lists[0].pk),
+            TestListReference,
+        ], batch_size=2)
+
+        self.assertEqual(
+            list(TestOrderedList.objects.values_list('pk', flat=True)),
+            [self.lists[0].pk])
+        self.assertEqual(TestOrderedListItem.objects.count(), 5)
+        self.assertEqual(TestItemDetails.objects.count(), 5)
+        self.assertEqual(
+            list(HashedList.objects.values_list('pk', flat=True)),
+            [self.hashed_list.pk])
+        self.assertEqual(TestListItem.objects.count(), 5)
+        self.assertEqual(TestItem.objects.count(), 5)
+
+    def test_no_roots(self):
+        with self.assertRaises(ValueError):
+            collect([])
+        with self.assertRaises(CommandError):
+            call_command('roesti_gc', stdout=StringIO())
+        self.assertEqual(TestItemDetails.objects.count(), 11)
+
+        # With an explicit opt-in, nothing is reachable.
+        report = collect([], dry_run=True, allow_no_roots=True)
+        self.assertEqual(report[TestItemDetails], 11)
+
+    def test_command(self):
+        stdout = StringIO()
+        call_command('roesti_gc', '--root', 'roesti.TestOrderedList',
+                     '--dry-run', stdout=stdout)
+        self.assertIn(
+            'roesti.TestItemDetails: 1 unreachable rows would be deleted',
+            stdout.getvalue())
+        self.assertEqual(TestItemDetails.objects.count(), 11)
+
+        call_command('roesti_gc', '--root', 'roesti.TestOrderedList',
+                     stdout=StringIO())
+        self.assertEqual(TestItemDetails.objects.count(), 10)
+        self.assertEqual(HashedList.objects.count(), 0)
+
+
+class TestPlainModel(models.Model):
+    text = models.TextField()
+
+
+class ArchiveTestCase(TestCase):
+    def setUp(self):
+        self.lists = TestOrderedList.objects.ensure([{
+            'name': 'List %d' % list_index,
+            'items': [{
+                'order': index,
+                'details': {
+                    'text': '%d Item %d' % (list_index, index)
+                }
+            } for index in range(5)]
+        } for list_index in range(2)])
+        items = [TestItem(text='Item %d' % index) for index in range(5)]
+        self.hashed_list = HashedList.objects.ensure_list(TestItem, items)
+
+    def dump(self, *roots):
+        archive = BytesIO()
+        dump(roots, archive, batch_size=3)
+        archive.seek(0)
+        return archive
+
+    def delete_all(self):
+        for model in [TestOrderedListItem, TestOrderedList, TestItemDetails,
+                      TestListItem, HashedList, TestItem]:
+            model.objects.all().delete()
+
+    def test_round_trip(self):
+        archive = self.dump(TestOrderedList, HashedList)
+        self.delete_all()
+
+        counts = load(archive)
+        self.assertEqual(counts[TestOrderedList], 2)
+        self.assertEqual(counts[TestOrderedListItem], 10)
+        self.assertEqual(counts[TestItemDetails], 10)
+        self.assertEqual(counts[HashedList], 1)
+        self.assertEqual(counts[TestListItem], 5)
+        self.assertEqual(counts[TestItem], 5)
+
+        self.assertEqual(
+            set(TestOrderedList.objects.values_list('name', flat=True)),
+            set(['List 0', 'List 1']))
+        validate_hashes(self, TestItemDetails.objects.all())
+        validate_hashes(self, TestItem.objects.all())
+        self.assertEqual(
+            [item.item.text for item in self.hashed_list.items.all()],
+            ['Item %d' % index for index in range(5)])
+
+    def test_load_delta(self):
+        archive = self.dump(TestOrderedList, HashedList)
+        TestOrderedListItem.objects.filter(lst=self.lists[1]).delete()
+        self.lists[1].delete()
+
+        # Only the deleted list and its items are missing. The list items'
+        # details still exist.
+        counts = load(archive)
+        self.assertEqual(counts[TestOrderedList], 1)
+        self.assertEqual(counts[TestOrderedListItem], 5)
+        self.assertEqual(counts[TestItemDetails], 0)
+        self.assertEqual(counts[HashedList], 0)
+        self.assertEqual(counts[TestListItem], 0)
+        self.assertEqual(TestOrderedList.objects.count(), 2)
+        self.assertEqual(TestListItem.objects.count(), 5)
+
+    def test_invalid_archive(self):
+        with self.assertRaises(OSError):
+            load(BytesIO(b'not an archive'))
+
+    def write_archive(self, path, *chunks):
+        with gzip.open(path, 'wt') as archive:
+            for line in ({'format': 'roesti', 'version': 1},) + chunks:
+                archive.write(json.dumps(line))
+                archive.write('\n')
+
+    def assertLoadFails(self, *chunks):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'archive.gz')
+            self.write_archive(path, *chunks)
+
+            with open(path, 'rb') as archive:
+                with self.assertRaises((LookupError, ValueError)):
+                    load(archive)
+            with self.assertRaises(CommandError):
+                call_command('roesti_load', path, stdout=StringIO())
+
+    def test_load_unknown_model(self):
+        self.assertLoadFails({
+            'model': 'roesti.Missing',
+            'columns': {'content_hash': ['0' * 32]}
+        })
+
+    def test_load_unhashed_model(self):
+        self.assertLoadFails({
+            'model': 'roesti.TestPlainModel',
+            'columns': {'id': [1], 'text': ['inserted']}
+        })
+        self.assertEqual(TestPlainModel.objects.count(), 0)
+
+    def test_load_malformed(self):
+        self.assertLoadFails({'model': 'roesti.TestItem'})
+        self.assertLoadFails({
+            'model': 'roesti.TestItem',
+            'columns': {'text': ['no key']}
+        })
+
+    def test_load_mismatched(self):
+        self.assertLoadFails({
+            'model': 'roesti.TestItem',
+            'columns': {
+                'content_hash': ['0' * 32, make_hash({'text': 'valid'})],
+                'text': ['forged', 'valid']
+            }
+        })
+        # Nothing from the archive was inserted.
+        self.assertFalse(TestItem.objects.filter(
+            text__in=['forged', 'valid']).exists())
+
+    def test_commands(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'archive.gz')
+            call_command('roesti_dump', path, '--root', 'roesti.HashedList',
+                         stdout=StringIO())
+            self.delete_all()
+
+            stdout = StringIO()
+            call_command('roesti_load', path, stdout=stdout)
+            self.assertIn('roesti.TestItem: 5 rows inserted',
+                          stdout.getvalue())
+            self.assertEqual(TestListItem.objects.count(), 5)
+
+
+class IntegrityTestCase(TestCase):
+    def setUp(self):
+        self.items = TestItem.objects.ensure([
+            {'text': 'Item %d' % index} for index in range(20)])
+        # Stored under the wrong key, with the same content as another row.
+        TestItem.objects.bulk_create([
+            TestItem(content_hash='0' * 32, text='Item 1'),
+            TestItem(content_hash='f' * 32, text='Changed'),
+        ])
+
+    def test_check(self):
+        report = check(TestItem, chunk_size=3)
+        self.assertEqual(report.checked, 22)
+        self.assertEqual(report.mismatched, {
+            '0' * 32: make_hash({'text': 'Item 1'}),
+            'f' * 32: make_hash({'text': 'Changed'}),
+        })
+        self.assertEqual(report.duplicates, {
+            make_hash({'text': 'Item 1'}): sorted([
+                '0' * 32, make_hash({'text': 'Item 1'})]),
+        })
+
+    def test_check_reverse_relations(self):
+        TestOrderedList.objects.ensure([{
+            'name': 'My list',
+            'items': [{
+                'order': index,
+                'details': {
+                    'text': 'Item %d' % index
+                }
+            } for index in range(10)]
+        }])
+        report = check(TestOrderedList)
+        self.assertEqual(report.checked, 1)
+        self.assertEqual(report.mismatched, {})
+
+    def test_check_sample(self):
+        report = check(TestItem, sample=0.5)
+        self.assertLess(report.checked, 22)
+
+    def test_command(self):
+        stdout = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('roesti_check', 'roesti.TestItem', stdout=stdout)
+        self.assertIn('roesti.TestItem: 22 rows checked, 2 mismatched, '
+                      '1 duplicated', stdout.getvalue())
+
+        TestItem.objects.filter(pk__in=['0' * 32, 'f' * 32]).delete()
+        call_command('roesti_check', 'roesti.TestItem', stdout=StringIO())
+
+    def test_check_uncheckable(self):
+        self.assertTrue(TestOrderedList.objects.is_checkable())
+        self.assertFalse(TestOrderedListItem.objects.is_checkable())
+        self.assertTrue(TestReferencesModel.objects.is_checkable())
+
+        with self.assertRaises(ValueError):
+            check(TestOrderedListItem)
+        with self.assertRaises(CommandError):
+            call_command('roesti_check', 'roesti.TestOrderedListItem',
+                         stdout=StringIO())
+
+    def test_check_sample_range(self):
+        for sample in [0, -0.5, 2]:
+            with self.assertRaises(ValueError):
+                check(TestItem, sample=sample)
+            with self.assertRaises(CommandError):
+                call_command('roesti_check', 'roesti.TestItem',
+                             '--sample', str(sample), stdout=StringIO())
+        self.assertEqual(check(TestItem, sample=1).checked, 22)
+
+    def test_check_workers(self):
+        with self.assertRaises(ValueError):
+            check(TestItem, workers=0)
+        with self.assertRaises(CommandError):
+            call_command('roesti_check', 'roesti.TestItem', '--workers', '0',
+                         stdout=StringIO())
+
+    @override_settings(ROESTI_VERIFY_RATE=1)
+    def test_verify_on_ensure_uncheckable(self):
+        data = [{
+            'name': 'My list',
+            'items': [{
+                'order': index,
+                'details': {
+                    'text': 'Item %d' % index
+                }
+            } for index in range(3)]
+        }]
+        TestOrderedList.objects.ensure(data)
+        with mock.patch.object(roesti_models.logger, 'warning') as warning:
+            TestOrderedList.objects.ensure(data)
+            self.assertFalse(warning.called)
+
+    @override_settings(ROESTI_VERIFY_RATE=1)
+    def test_verify_on_ensure(self):
+        with self.assertLogs('roesti.models', 'WARNING') as logs:
+            TestItem.objects.ensure([
+                TestItem(content_hash='f' * 32, text='Changed')])
+        self.assertEqual(logs.output, [
+            'WARNING:roesti.models:roesti.TestItem %s has content hash %s' % (
+                'f' * 32, make_hash({'text': 'Changed'}))
+        ])
+
+
+class ParallelIntegrityTestCase(TransactionTestCase):
+    def test_check_workers(self):
+        TestItem.objects.ensure([
+            {'text': 'Item %d' % index} for index in range(20)])
+        TestItem.objects.bulk_create([
+            TestItem(content_hash='0' * 32, text='Item 1')])
+
+        report = check(TestItem, workers=4)
+        self.assertEqual(report.checked, 21)
+        self.assertEqual(list(report.mismatched), ['0' * 32])
+        self.assertEqual(len(report.duplicates), 1)
+
+
+class BatchTestCase(TestCase):
+    def test_batch(self):
+        references = [{
+            'test_model_1': {
+                'char_field_1': 'field 1 value 1',
+                'integer_field_1': 1
+            },
+            'test_model_2': {
+                'char_field_1': 'field 1 value 2',
+                'integer_field_1': 2
+            },
+            'integer_field_1': 3
+        }]
+        models = [{
+            'char_field_1': 'field 1 value 1',
+            'integer_field_1': 1
+        }, {
+            'char_field_1': 'field 1 value 3',
+            'integer_field_1': 3
+        }]
+        items = [TestItem(text='Item %d' % index) for index in range(10)]
+
+        # One to query existing and one to insert, for each of TestModel,
+        # TestReferencesModel, TestItem and HashedList. One to insert the
+        # list items. No transaction queries, since we're already in one.
+        with self.assertNumQueries(9):
+            with HashedModel.batch() as batch:
+                reference_instances = batch.ensure(TestReferencesModel,
+                                                   references)
+                model_instances = batch.ensure(TestModel, models)
+                lst = batch.ensure_list(TestItem, items)
+
+        validate_hashes(self, reference_instances)
+        validate_hashes(self, model_instances)
+        self.assertEqual(TestModel.objects.count(), 3)
+        self.assertEqual(TestReferencesModel.objects.count(), 1)
+        self.assertEqual(
+            [item.item.text for item in lst.items.all()],
+            ['Item %d' % index for index in range(10)])
+
+        # The same list as `HashedList.objects.ensure_list` would make.
+        self.assertEqual(
+            HashedList.objects.ensure_list(TestItem, items).pk, lst.pk)
+
+        # Everything exists, so only query for existing rows.
+        with self.assertNumQueries(4):
+            with HashedModel.batch() as batch:
+                batch.ensure(TestReferencesModel, references)
+                batch.ensure(TestModel, models)
+                batch.ensure_list(TestItem, items)
+
+    def test_batch_reverse_references(self):
+        with self.assertNumQueries(6):
+            with HashedModel.batch() as batch:
+                instances = batch.ensure(TestOrderedList, [{
+                    'name': 'My list %d' % list_index,
+                    'items': [{
+                        'order': index,
+                        'details': {
+                            'text': '%d Item %d' % (list_index, index)
+                        }
+                    } for index in range(10)]
+                } for list_index in range(2)])
+        self.assertEqual(len(instances), 2)
+        self.assertEqual(TestOrderedList.objects.count(), 2)
+        self.assertEqual(TestItemDetails.objects.count(), 20)
+        self.assertEqual(TestOrderedListItem.objects.count(), 20)
+
+    @override_settings(ROESTI_VERIFY_RATE=1)
+    def test_batch_verify(self):
+        TestItem.objects.bulk_create([
+            TestItem(content_hash='f' * 32, text='Changed')])
+        with self.assertLogs('roesti.models', 'WARNING') as logs:
+            with HashedModel.batch() as batch:
+                batch.ensure(TestItem, [
+                    TestItem(content_hash='f' * 32, text='Changed')])
+        self.assertEqual(logs.output, [
+            'WARNING:roesti.models:roesti.TestItem %s has content hash %s' % (
+                'f' * 32, make_hash({'text': 'Changed'}))
+        ])
+
+    def test_batch_error(self):
+        with self.assertRaises(ValueError):
+            with HashedModel.batch() as batch:
+                batch.ensure(TestModel, [{
+                    'char_field_1': 'field 1 value 1',
+                    'integer_field_1': 1
+                }])
+                raise ValueError()
+        self.assertEqual(TestModel.objects.count(), 0)